@@ -1,4 +1,5 @@
-from .views import DrillDownAPIView
+from .renderers import OrjsonRenderer
+from .views import CachedDrilldownMixin, DrillDownAPIView
 
 VERSION = (0, 1, 1)
 __version__ = VERSION # alias
\ No newline at end of file
@@ -1,10 +1,16 @@
+import datetime
+import json
 from decimal import Decimal
 from django.db import models
 from django.conf import settings
+from django.core.cache import cache
 from django.test import TestCase
 from django.test.client import RequestFactory
+from django.utils.timezone import utc
+from rest_framework.renderers import JSONRenderer
 
-from .views import DrillDownAPIView
+from .renderers import OrjsonRenderer
+from .views import CachedDrilldownMixin, DrillDownAPIView
 
 
 # Create some database models
@@ -34,6 +40,7 @@ class test_Invoice(models.Model):
     salesperson = models.ForeignKey(test_Salesperson, null=True)
     items = models.ManyToManyField(test_Item,  related_name='invoice')
     total = models.DecimalField(decimal_places=2, max_digits=8, default=Decimal('0'))
+    created = models.DateTimeField(auto_now_add=True)
 
     def save(self, *args, **kwargs):
         if self.id:
@@ -68,6 +75,25 @@ class TwoItemMaxTestAPI(DrilldownTestAPI):
     MAX_RESULTS = 2
 
 
+# Build another whose base query has its own select_related
+class SelectRelatedBaseTestAPI(DrilldownTestAPI):
+    """a subclass of DrilldownTestAPI with select_related in its base query"""
+    def get_base_query(self):
+        return test_Invoice.objects.select_related('salesperson')
+
+
+# Build another that prefetches the client instead of joining it
+class PrefetchClientTestAPI(DrilldownTestAPI):
+    """a subclass of DrilldownTestAPI that gets clients with prefetch_related"""
+    force_prefetch = ['client']
+
+
+# Build another that caches its responses
+class CachedTestAPI(CachedDrilldownMixin, DrilldownTestAPI):
+    """a subclass of DrilldownTestAPI that caches responses"""
+    cache_timeout = 60
+
+
 class DrilldownAPITest(TestCase):
     def setUp(self):
         mary_smith = test_Profile(last_name='Smith', first_name='Mary', spy_name='Mango')
@@ -163,6 +189,14 @@ class DrilldownAPITest(TestCase):
         response = get_response({'fields': 'items'})
         # data should look something like this: [{'items': [1, 2]}], NOT [{'items': [{'id': 1}, {'id': 2}]}]
         self.assertTrue(type(response.data[0]['items'][0]) is int)
+        self.assertEqual(int(response.get('X-Query-Count', 0)), 2)  # one for invoices, one for the item ids
+
+        # rendered json is what JSONRenderer gives for the serializer's data
+        response = get_response({'fields': 'ALL'})
+        response.render()
+        rows = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows, json.loads(JSONRenderer().render(response.data).decode('utf-8')))
 
         # try with limit
         response = get_response({'limit': 1})
@@ -173,12 +207,49 @@ class DrilldownAPITest(TestCase):
         response = get_response({'offset': 3})
         self.assertEqual(len(response.data), 2)
         self.assertEqual(int(response.get('X-Total-Count', 0)), 5)
+        self.assertEqual(int(response.get('X-Query-Count', 0)), 1)  # partial page, so no count query needed
+
+        # offset past the end
+        response = get_response({'offset': 10})
+        self.assertEqual(len(response.data), 0)
+        self.assertEqual(int(response.get('X-Total-Count', 0)), 5)
 
         # both, with arbitrary high limit
         response = get_response({'offset': 2, 'limit': 100})
         self.assertEqual(len(response.data), 3)
         self.assertEqual(int(response.get('X-Total-Count', 0)), 5)
 
+        # count=none returns X-Has-More instead of X-Total-Count
+        response = get_response({'limit': 2, 'count': 'none'})
+        self.assertEqual(len(response.data), 2)
+        self.assertEqual(response.get('X-Has-More'), 'true')
+        self.assertIsNone(response.get('X-Total-Count'))
+        self.assertEqual(int(response.get('X-Query-Count', 0)), 1)  # no count query
+        response = get_response({'limit': 2, 'offset': 4, 'count': 'none'})
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.get('X-Has-More'), 'false')
+
+        # count=estimate falls back to an exact count on databases without an estimate
+        response = get_response({'limit': 1, 'count': 'estimate'})
+        self.assertEqual(int(response.get('X-Total-Count', 0)), 5)
+
+        # streamed
+        response = get_response({'stream': '1', 'fields': 'id,client.profile.first_name,items', 'limit': 3})
+        rows = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(rows[0]['client']['profile']['first_name'])
+        self.assertTrue(type(rows[0]['items'][0]) is int)
+        self.assertEqual(int(response.get('X-Total-Count', 0)), 5)
+
+        # order_by
+        response = get_response({'order_by': '-client.profile.first_name,total', 'fields': 'client.profile.first_name'})
+        self.assertEqual(response.data[0]['client']['profile']['first_name'], 'Mary')
+        response = get_response({'order_by': 'client.profile.dog_name'})
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue('dog_name' in response.get('X-Query_Error'))
+        response = get_response({'order_by': 'salesperson.commission_pct'})  # a hide field
+        self.assertEqual(response.status_code, 400)
+
         # zero results
         response = get_response({'salesperson.profile.first_name': 'Fred'})
         self.assertEqual(response.status_code, 200)  # not an error
@@ -227,3 +298,114 @@ class DrilldownAPITest(TestCase):
         self.assertIsNotNone(response.data[0]['salesperson'].get('profile'))
 
         settings.DEBUG = saved_debug  # revert settings
+
+    def test_cached_api(self):
+        cached_view = CachedTestAPI.as_view()
+        cache.clear()
+
+        def cached_response(data):
+            return cached_view(self.factory.get('/url/', data, content_type='application/json'))
+
+        response = cached_response({'fields': 'id,total', 'limit': 2})
+        self.assertEqual(len(response.data), 2)
+        self.assertEqual(int(response.get('X-Total-Count', 0)), 5)
+
+        # a new invoice doesn't show up in the cached response, with its headers
+        test_Invoice(client=test_Client.objects.all()[0]).save()
+        response = cached_response({'limit': 2, 'fields': 'id,total'})  # same params, different order
+        self.assertEqual(int(response.get('X-Total-Count', 0)), 5)
+
+        # but different params aren't cached
+        response = cached_response({'fields': 'id,total', 'limit': 3})
+        self.assertEqual(int(response.get('X-Total-Count', 0)), 6)
+        cache.clear()
+
+    def test_force_prefetch(self):
+        prefetch_view = PrefetchClientTestAPI.as_view()
+        saved_debug = settings.DEBUG
+        settings.DEBUG = True
+
+        response = prefetch_view(self.factory.get('/url/', {'fields': 'id,client.wholesale'},
+                                                  content_type='application/json'))
+        self.assertEqual(len(response.data), 5)
+        self.assertTrue(response.data[0]['client']['wholesale'] in [True, False])
+        self.assertEqual(int(response.get('X-Query-Count', 0)), 2)  # clients come from a second query
+
+        # relateds below the prefetched client are selected in the clients' query
+        response = prefetch_view(self.factory.get('/url/', {'fields': 'id,client.profile.first_name'},
+                                                  content_type='application/json'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data[0]['client']['profile']['first_name'])
+        self.assertEqual(int(response.get('X-Query-Count', 0)), 2)
+
+        settings.DEBUG = saved_debug  # revert settings
+
+    def test_base_query_select_related(self):
+        view = SelectRelatedBaseTestAPI.as_view()
+        response = view(self.factory.get('/url/', {'fields': 'id,items'}, content_type='application/json'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 5)
+
+    def test_reverse_many_to_many_left_out(self):
+        view = DrilldownTestAPI.as_view()
+        response = view(self.factory.get('/url/', {'fields': 'items.ALL'}, content_type='application/json'))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('invoice', response.data[0]['items'][0])
+        response = view(self.factory.get('/url/', {'fields': 'items.invoice'}, content_type='application/json'))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('invoice', response.data[0]['items'][0])
+
+    def test_as_view_initkwargs(self):
+        # settings passed to as_view() are used, and don't leak into other views of the same class
+        view = DrilldownTestAPI.as_view(drilldowns=['client__profile'])
+        response = view(self.factory.get('/url/', {'fields': 'items.description'},
+                                         content_type='application/json'))
+        self.assertEqual(response.status_code, 400)
+        view = DrilldownTestAPI.as_view()
+        response = view(self.factory.get('/url/', {'fields': 'items.description'},
+                                         content_type='application/json'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_orjson_renderer(self):
+        # gives the same json as JSONRenderer, including for the types DRF's encoder handles itself
+        data = [{'total': Decimal('1.50'), 'when': datetime.datetime(2014, 5, 1, 12, 30, 15, 123456, tzinfo=utc),
+                 'day': datetime.date(2014, 5, 1), 1: None}]
+        self.assertEqual(json.loads(OrjsonRenderer().render(data).decode('utf-8')),
+                         json.loads(JSONRenderer().render(data).decode('utf-8')))
+
+    def test_all_fields(self):
+        view = DrilldownTestAPI.as_view()
+        response = view(self.factory.get('/url/', {'fields': 'ALL'}, content_type='application/json'))
+        self.assertEqual(response.status_code, 200)
+        invoice = test_Invoice.objects.get(id=response.data[0]['id'])
+        self.assertEqual(sorted(response.data[0]['items']), sorted(i.id for i in invoice.items.all()))
+        self.assertEqual(response.data[0]['client'], invoice.client_id)  # ids only
+
+    def test_fast_paths_match_serializer(self):
+        # the fast path gives the same data (and json) as the serializer, which fields=ALL goes through
+        view = DrilldownTestAPI.as_view()
+
+        def first_row(fields):
+            response = view(self.factory.get('/url/', {'fields': fields, 'order_by': 'id'},
+                                             content_type='application/json'))
+            response.render()
+            return response.data[0], json.loads(response.content.decode('utf-8'))[0]
+
+        all_data, all_json = first_row('ALL')
+        fast_data, fast_json = first_row('id,total,created,items')
+        for name in ['id', 'total', 'created', 'items']:
+            self.assertEqual(fast_data[name], all_data[name])
+            self.assertEqual(fast_json[name], all_json[name])
+
+        # and so does the .values() path
+        values_data, values_json = first_row('id,total,created,client')
+        for name in ['id', 'total', 'created', 'client']:
+            self.assertEqual(values_data[name], all_data[name])
+            self.assertEqual(values_json[name], all_json[name])
+
+    def test_bad_force_select(self):
+        # force_select only takes relations that select_related can follow
+        view = DrilldownTestAPI.as_view(force_select=['items'])
+        response = view(self.factory.get('/url/', {'fields': 'id'}, content_type='application/json'))
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue('force_select' in response.get('X-Query_Error'))
@@ -1,11 +1,36 @@
+import hashlib
+import json
+import re
+from collections import defaultdict
+
 from django.conf import settings
-from django.db import connection
-from django.db.models.fields.related import ForeignKey, OneToOneField, ManyToManyField, ManyToOneRel, OneToOneRel
+from django.core.cache import cache
+from django.db import connection, connections
+from django.db.models import (AutoField, BooleanField, CharField, FileField, FloatField, IntegerField, Manager, Max,
+                              NullBooleanField, Prefetch, TextField)
+from django.db.models.query import prefetch_related_objects
+from django.db.models.fields.related import (ForeignKey, OneToOneField, ManyToManyField, ManyToOneRel, OneToOneRel,
+                                             ManyToManyRel)
 from django.core.exceptions import FieldError
+from django.http import StreamingHttpResponse
 from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from .renderers import OrjsonRenderer, json_dumps
+
+
+_INT_RE = re.compile(r'\s*[-+]?[0-9]+\s*\Z')  # what int() takes, less underscores
+
+# true/True and false/False filter values become booleans
+_BOOL_MAP = {'true': True, 'True': True, 'false': False, 'False': False}
+
+_STREAM_CHUNK_SIZE = 100  # objects loaded at a time when streaming
+
+# compiled drilldowns, hide sets, etc., keyed by the view settings they come from (which are fixed in code)
+_COMPILED_CACHE = {}
+
 
 class DrillDownAPIView(APIView):
     """
@@ -18,8 +43,21 @@ class DrillDownAPIView(APIView):
         limit and offset:
             limit=10&offset=60
 
+        count:
+            count=exact  < the default; X-Total-Count is the exact total, which may take a count query
+            count=estimate  < X-Total-Count is the database's estimate where available (PostgreSQL), else exact
+            count=none  < no X-Total-Count; X-Has-More says whether there are more results after this page
+
+        stream:
+            stream=1  < write the results out as they're read from the db, rather than building them all up in
+                        memory first (json only; X-Has-More is not available, count=exact will always run a count
+                        query, and X-Query-Count leaves out the queries run while streaming). Also set
+                        STREAM_RESULTS on the view to stream whenever limit is that big.
+
         order_by:
             order_by=-client.profile.first_name  <  order by associated client's first name, in reverse order
+            (Ordering is constrained to fields of the model and its drilldowns, less any hide fields, or to the
+            allowed_order_by setting in the view, if it's set.)
 
         fields:
             fields=id,client.profile.first_name < returns the item id and associated client's first name
@@ -33,8 +71,17 @@ class DrillDownAPIView(APIView):
             amount__gt=100  < amount greater than 100
             (Multiple filters can be combined. Filterable objects are also constrained to those in the drilldowns list.)
 
+    Relateds:
+        ForeignKeys and OneToOnes are fetched in the same query with select_related; ManyToManys are fetched in a
+        second query with prefetch_related. List paths (like drilldowns) in force_prefetch or force_select to change
+        that. E.g. a ForeignKey to a wide table where most rows share a few parents is cheaper to prefetch, since
+        each parent is fetched once instead of being joined onto every row. (force_select only takes paths of
+        ForeignKeys and OneToOnes, which Django can select_related; anything else errors 400.) Relateds below a
+        prefetched one are selected in the prefetch's query.
+
     Returns results with header codes:
         X-Total-Count: the total match count before applying limit or offset
+        X-Has-More: true or false, whether there are results past this page (with count=none only)
         X-Query_Error: any errors, usually returned with status 400
         X-Query_Warning: warning, returned with status 200
     """
@@ -43,35 +90,116 @@ class DrillDownAPIView(APIView):
     hide = None
     model = None  # override this with the model
     picky = False  # if true, will error 400 if any bad fields are included
+    force_select = None  # override this with relateds to always get with select_related
+    force_prefetch = None  # override this with relateds to always get with prefetch_related
+    allowed_order_by = None  # override this to limit order_by to these fields, e.g. ones with indexes
     MAX_RESULTS = 1000  # max result count; can override in your api
+    STREAM_RESULTS = None  # if set, stream the response whenever the limit is at least this many results
+    # json goes through orjson (if installed); the other default renderers are kept
+    renderer_classes = [OrjsonRenderer if r is JSONRenderer else r for r in APIView.renderer_classes]
 
     def __init__(self, *args, **kwargs):
         self.error = ''
         self.warning = ''
 
-        # deal with None's that should be arrays
-        self.ignore = self.ignore or []
-        self.drilldowns = self.drilldowns or []
-        self.hide = self.hide or []
-
         # These will go into the query
         self.select_relateds = []
         self.prefetch_relateds = []
 
-        # Non-model fields that may be in the query
-        self.hide_fields = [h.replace('__', '.') for h in self.hide]
-        self.ignore_fields = set(['fields', 'limit', 'offset', 'format', 'order_by'] + self.ignore + self.hide_fields)
-
-        super(DrillDownAPIView, self).__init__(*args, **kwargs)
+        super(DrillDownAPIView, self).__init__(*args, **kwargs)  # sets any as_view() initkwargs
+
+        # drilldowns, hide and ignore are fixed per view, so they're only worked out once
+        self.__dict__.update(self._get_compiled())
+        self.drilldowns = self._validated_drilldowns
+        self.hide_fields = self._hide_set
+        self.ignore_fields = self._ignore_set
+
+    def _get_compiled(self):
+        """
+        Get the drilldowns trie, the hide and ignore sets, etc. for this view's settings (from the class or from
+        as_view() initkwargs), working them out the first time those settings are seen
+        """
+        key = (self.model, tuple(self.drilldowns or []), tuple(self.hide or []), tuple(self.ignore or []),
+               tuple(self.force_select or []), tuple(self.force_prefetch or []),
+               None if self.allowed_order_by is None else tuple(self.allowed_order_by))
+        compiled = _COMPILED_CACHE.get(key)
+        if compiled is None:
+            validated_drilldowns, trie, error = self._validate_drilldowns(self.drilldowns or [])
+            hide_set = frozenset(h.replace('__', '.') for h in self.hide or [])
+            force_select_set = frozenset(f.replace('.', '__') for f in self.force_select or [])
+            compiled = _COMPILED_CACHE[key] = {
+                '_validated_drilldowns': tuple(validated_drilldowns),
+                '_drilldown_trie': trie,
+                '_drilldowns_error': error,
+                '_hide_set': hide_set,
+                '_ignore_set': frozenset(['fields', 'limit', 'offset', 'format', 'order_by', 'count', 'stream'] +
+                                         list(self.ignore or []) + list(hide_set)),
+                '_force_select_set': force_select_set,
+                '_force_select_error': self._validate_force_select(force_select_set),
+                '_force_prefetch_set': frozenset(f.replace('.', '__') for f in self.force_prefetch or []),
+                '_order_by_set': self._get_order_by_set(validated_drilldowns, hide_set),
+                '_filter_path_map': self._get_filter_path_map(validated_drilldowns, hide_set),
+                '_settings_key': key,
+            }
+        return compiled
+
+    def _get_order_by_set(self, validated_drilldowns, hide_set):
+        """Get the set of fields (in __ form) that order_by may use"""
+        if self.allowed_order_by is not None:
+            return frozenset(f.replace('.', '__') for f in self.allowed_order_by)
+        if self.model is None:
+            return frozenset()
+
+        order_by_set = set(['pk'])
+        for related_string, current_model in self._drilldown_models(validated_drilldowns):
+            for fieldname in _all_field_names(current_model):
+                if get_field_type(current_model, fieldname) in [ManyToManyField, ManyToOneRel, ManyToManyRel]:
+                    continue  # many-valued relations would repeat rows
+                order_by_string = (related_string + '__' + fieldname).strip('__')
+                if order_by_string.replace('__', '.') not in hide_set:
+                    order_by_set.add(order_by_string)
+        return frozenset(order_by_set)
+
+    def _get_filter_path_map(self, validated_drilldowns, hide_set):
+        """
+        Get a dict of every field that can be filtered on, from the dotted form used in the request to the __ form
+        used in the query, e.g. {'client.profile.last_name': 'client__profile__last_name', ...}
+        """
+        if self.model is None:
+            return {}
+
+        filter_path_map = {}
+        for related_string, current_model in self._drilldown_models(validated_drilldowns):
+            for fieldname in _all_field_names(current_model):
+                filter_string = (related_string + '__' + fieldname).strip('__')
+                dot_string = filter_string.replace('__', '.')
+                if dot_string not in hide_set:
+                    filter_path_map[dot_string] = filter_string
+        return filter_path_map
+
+    def _drilldown_models(self, validated_drilldowns):
+        """Yields (related_string, model) for the view's model (as '') and for each of the drilldowns"""
+        yield '', self.model
+        for related_string in validated_drilldowns:
+            current_model = self.model
+            for fieldname in related_string.split('__'):
+                current_model = get_model(current_model, fieldname)
+            yield related_string, current_model
 
     def get_base_query(self):   # override this to return your base query
         return None
 
     def get(self, request):
         """The main method in this object; handles a GET request with filters, fields, etc."""
-        if settings.DEBUG:
-            num_queries = len(connection.queries)  # just for testing
+        if not settings.DEBUG:
+            return self._get(request)
+
+        with QueryCounter(connection) as query_counter:  # just for testing
+            response = self._get(request)
+        response['X-Query-Count'] = query_counter.count
+        return response
 
+    def _get(self, request):
         data = {}
         headers = {}
 
@@ -100,10 +228,9 @@ class DrillDownAPIView(APIView):
         if qs is None:
             return _error('API error: get_base_query() missing or invalid')
 
-        # Get the complete set of drilldowns
-        self.drilldowns = self._validate_drilldowns(self.drilldowns)
-        if self.error:
-            return _error(self.error)
+        # Check the drilldowns and force_select (validated once per view settings)
+        if self._drilldowns_error or self._force_select_error:
+            return _error(self._drilldowns_error or self._force_select_error)
 
         # Create the fields_map (a multi-level dictionary describing the fields to be returned)
         self.fields_map = self._create_fields_map(fields)
@@ -115,11 +242,22 @@ class DrillDownAPIView(APIView):
         if self.error:
             return _error(self.error)
 
+        # Get the columns to pull from the db (skipped for ALL, where the field list is open-ended)
+        uses_all = any('ALL' in f.split('.') for f in fields)
+        only_fields = []
+        if self.fields_map and not uses_all:
+            only_fields = self._set_only_fields(self.fields_map)
+        if qs.query.select_related or qs.query.deferred_loading[0]:
+            # the base query has its own select_related or deferred fields, which .only() could clash with
+            only_fields = []
+
         # Add our relateds to the query
         if self.select_relateds:
             qs = qs.select_related(*self.select_relateds)
         if self.prefetch_relateds:
             qs = qs.prefetch_related(*self.prefetch_relateds)
+        if only_fields:
+            qs = qs.only(*only_fields)
 
         # Add our filters to the query
         try:
@@ -132,142 +270,264 @@ class DrillDownAPIView(APIView):
             return _error('Bad filter value in query')
         queryset_for_count = qs  # saving this off so we can use it later before we add limits
 
-        # Deal with ordering
+        # Deal with ordering; validate the fields first, rather than finding out when the query fails
         order_by = self.request.QUERY_PARAMS.get('order_by', '').replace('.', '__')
-        # would be nice to validate order_by fields here, but difficult, so we just trap below
         if order_by:
             order_by = order_by.split(',')
+            annotations = getattr(qs.query, 'annotations', {})  # e.g. counts added by get_base_query()
+            for o in order_by:
+                if o.lstrip('-') not in self._order_by_set and o.lstrip('-') not in annotations:
+                    return _error('Bad order_by field: %s' % o.lstrip('-').replace('__', '.'))
             qs = qs.order_by(*order_by)
 
+        # If it's just flat fields and foreign keys, get plain dicts from the db rather than model instances
+        fields_map = self.fields_map or {'id': {}}
+        values_plan = None
+        if not (uses_all or qs._prefetch_related_lookups):
+            values_plan = _get_values_plan(self.model, fields_map)
+        if values_plan:
+            qs = qs.values(*values_plan[0])
+
         # Deal with offset and limit
         self.offset = int_or_none(self.request.QUERY_PARAMS.get('offset')) or 0
         self.limit = int_or_none(self.request.QUERY_PARAMS.get('limit')) or 0
         self.limit = min(self.MAX_RESULTS, self.limit or self.MAX_RESULTS)
+
+        # Stream the results if asked to; only for json, since streaming skips the renderers
+        stream = (self.request.QUERY_PARAMS.get('stream') in ['1', 'true', 'True'] or
+                  bool(self.STREAM_RESULTS and self.limit >= self.STREAM_RESULTS))
+        stream = stream and getattr(getattr(request, 'accepted_renderer', None), 'format', None) == 'json'
+
+        # Deal with counting; with count=none we fetch one extra row to see if there are more
+        count = self.request.QUERY_PARAMS.get('count', 'exact')
+        if count not in ['exact', 'estimate', 'none']:
+            return _error('Bad count parameter in query (use exact, estimate, or none)')
+        extra = 1 if count == 'none' and not stream else 0
+
         if self.limit and self.offset:
-            qs = qs[self.offset:self.limit + self.offset]
+            qs = qs[self.offset:self.limit + self.offset + extra]
         elif self.limit:
-            qs = qs[:self.limit]
+            qs = qs[:self.limit + extra]
         elif self.offset:
             qs = qs[self.offset:]
 
-        # create the chained serializer
-        serializer = DrilldownSerializerFactory(self.model)(fields_map=self.fields_map, instance=qs, many=True)
+        if stream:
+            # the rows are read as the response is written out, after get() returns, so their queries aren't
+            # in X-Query-Count
+            if values_plan:
+                rows = (_reshape_values(row, values_plan[1]) for row in qs.iterator())
+            elif not uses_all and _can_fast_serialize(self.model, fields_map):
+                rows = (_fast_serialize(obj, fields_map, self.model)
+                        for obj in _iter_in_chunks(qs, fields_map, self.model))
+            else:
+                serializer_class = DrilldownSerializerFactory(self.model, self.fields_map)
+                rows = (serializer_class(obj).data for obj in _iter_in_chunks(qs, fields_map, self.model))
+            response = StreamingHttpResponse(_json_stream(rows), content_type='application/json')
+            if count != 'none':
+                response['X-Total-Count'] = self._get_total_count(queryset_for_count, estimate=count == 'estimate')
+            if self.warning:
+                response['X-Query_Warning'] = self.warning
+            return response
+
+        if extra or not values_plan:
+            qs = list(qs)
+        if extra:
+            has_more = len(qs) > self.limit
+            qs = qs[:self.limit]
+        if not values_plan:
+            set_m2m_ids(qs, fields_map, self.model)  # one query for each ids-only many-to-many
 
         # return the response
-        try:
+        if values_plan:
+            data = [_reshape_values(row, values_plan[1]) for row in qs]
+        elif not uses_all and _can_fast_serialize(self.model, fields_map):
+            # just read the loaded attributes, skipping DRF's serializers
+            data = [_fast_serialize(obj, fields_map, self.model) for obj in qs]
+        else:
+            # create the chained serializer
+            serializer = DrilldownSerializerFactory(self.model, self.fields_map)(instance=qs, many=True)
             data = serializer.data
-        except FieldError:
-            return _error('Error: May be bad field name in order_by')  # typical error
 
-        # get total count if 1) your count = the limit, or 2) the query has an offset.
-        if self.offset or (len(data) and len(data) == self.limit):
-            total_count = queryset_for_count.count()
-            if len(data) == self.MAX_RESULTS:
-                self.warning += 'Number of results hit global maximum (%s results).  ' % self.MAX_RESULTS
+        if len(data) == self.MAX_RESULTS:
+            self.warning += 'Number of results hit global maximum (%s results).  ' % self.MAX_RESULTS
+        if count == 'none':
+            headers = {'X-Has-More': 'true' if has_more else 'false'}
         else:
-            total_count = len(data)
-        headers = {'X-Total-Count': total_count}
-        if settings.DEBUG:
-            headers['X-Query-Count'] = len(connection.queries) - num_queries
+            headers = {'X-Total-Count': self._get_total_count(queryset_for_count, len(data), count == 'estimate')}
         return _result()
 
     #  Various Methods  #
-    # Validate the list of drilldowns and fill in any gaps; returns array of drilldowns
+    def _get_total_count(self, queryset_for_count, result_count=None, estimate=False):
+        """
+        Get the total match count, only running a count query if the page of results doesn't tell us;
+        result_count is None if the page of results isn't known yet (e.g. when streaming)
+        """
+        if result_count is not None:
+            if result_count and result_count < self.limit:
+                return self.offset + result_count  # a partial page is the last page
+            if not (result_count or self.offset):
+                return 0
+        if estimate:
+            estimated_count = estimate_count(queryset_for_count)
+            if estimated_count is not None:
+                return max(estimated_count, self.offset + (result_count or 0))
+        return queryset_for_count.count()  # a full page, or an offset past the end
+
+    # Validate the list of drilldowns and fill in any gaps; returns array of drilldowns, the trie, and any error
     def _validate_drilldowns(self, drilldowns):
         ERROR_STRING = 'Error in drilldowns'
         validated_drilldowns = []
-
-        def validate_me(current_model, dd_string, current_string=''):
-            pair = dd_string.split('__', 1)
-            fieldname = (pair[0]).strip()
-            if not is_field_in(current_model, fieldname):
-                self.error = ('%s: "%s" is not a valid field in %s. Remember __ not .)' %
-                              (ERROR_STRING, fieldname, current_model.__name__))
-                return None
-            new_model = get_model(current_model, fieldname)
-            if not new_model:
-                self.error = ('%s: "%s" is not a ForeignKey, ManyToMany, OneToOne, ManyToOneRel, or OneToOneRel.'
-                              % (ERROR_STRING, fieldname))
-                return None
-            current_string = (current_string + '__' + fieldname).strip('__')
-
-            # note that we add missing intermediate models, e.g. 'client' if list included 'client__profile'
-            if current_string not in validated_drilldowns:
-                validated_drilldowns.append(current_string)
-                # if there's more, keep drilling
-            if len(pair) > 1:
-                validate_me(new_model, pair[1], current_string)  # recursion
+        trie = {}  # nested dicts, e.g. {'client': {'profile': {}}}
+        errors = []
 
         for dd in drilldowns:
-            validate_me(self.model, dd)
-        if ERROR_STRING in self.error:
-            validated_drilldowns = []
-        return validated_drilldowns
+            current_model, current_node, current_string = self.model, trie, ''
+            for fieldname in dd.split('__'):
+                fieldname = fieldname.strip()
+                if not is_field_in(current_model, fieldname):
+                    errors.append('%s: "%s" is not a valid field in %s. Remember __ not .)' %
+                                  (ERROR_STRING, fieldname, current_model.__name__))
+                    break
+                new_model = get_model(current_model, fieldname)
+                if not new_model:
+                    errors.append('%s: "%s" is not a ForeignKey, ManyToMany, OneToOne, ManyToOneRel, or OneToOneRel.'
+                                  % (ERROR_STRING, fieldname))
+                    break
+                current_string = (current_string + '__' + fieldname).strip('__')
+
+                # note that we add missing intermediate models, e.g. 'client' if list included 'client__profile'
+                if fieldname not in current_node:
+                    current_node[fieldname] = {}
+                    validated_drilldowns.append(current_string)
+                # if there's more, keep drilling
+                current_model, current_node = new_model, current_node[fieldname]
+        if errors:
+            return [], {}, errors[-1]
+        return validated_drilldowns, trie, ''
+
+    def _validate_force_select(self, force_select_set):
+        """Return an error if any force_select path isn't made of relations that select_related can follow"""
+        for related_string in sorted(force_select_set):
+            current_model = self.model
+            for fieldname in related_string.split('__'):
+                if not is_field_in(current_model, fieldname) or get_field_type(current_model, fieldname) not in [
+                        ForeignKey, OneToOneField, OneToOneRel]:
+                    return ('Error in force_select: "%s" is not a ForeignKey, OneToOne, or OneToOneRel.' %
+                            related_string.replace('__', '.'))
+                current_model = get_model(current_model, fieldname)
+        return ''
+
+    def _in_drilldowns(self, related_string):
+        """Return true if a related string like 'client__profile' is in the drilldowns"""
+        node = self._drilldown_trie
+        for fieldname in related_string.split('__'):
+            node = node.get(fieldname)
+            if node is None:
+                return False
+        return True
 
     def _create_fields_map(self, fields):
         """Take the list of fields submitted in the query and turn it into a multi-level tree dict"""
         fields_map = {}
         ERROR_STRING = 'Error in fields'
+        select_roots = {}  # related string -> the prefetch it's fetched in ('' for the main query)
+        prefetch_selects = {}  # prefetched related string -> relateds to select_related in its query
+
+        def add_related(current_related, field_type):
+            parent = current_related.rpartition('__')[0]
+            if current_related in self._force_prefetch_set or not (
+                    current_related in self._force_select_set or
+                    field_type in [ForeignKey, OneToOneField, ManyToOneRel, OneToOneRel]):
+                self.prefetch_relateds.append(current_related)
+                select_roots[current_related] = current_related
+                prefetch_selects.setdefault(current_related, [])
+                return
+            root = select_roots.get(parent, '')
+            select_roots[current_related] = root
+            if not root:
+                self.select_relateds.append(current_related)
+            elif current_related[len(root) + 2:] not in prefetch_selects[root]:
+                prefetch_selects[root].append(current_related[len(root) + 2:])  # selected in the prefetch query
 
         def add_to_fields_map(current_model, current_map, dot_string, current_related=''):
-            pair = dot_string.split('.', 1)
-            fieldname = (pair[0]).strip()
-            there_are_subfields = len(pair) > 1
-            if not (fieldname == 'ALL' or is_field_in(current_model, fieldname)):  # ALL is allowed in fields_map
-                self.error = ('%s: "%s" is not a valid field' % (ERROR_STRING, dot_string))
-                return None
-
-            if fieldname == 'ALL':
-                # add in all the fields for the model
-                fname_prefix = current_related.replace('__', '.') + '.'
-                for fname in current_model._meta.get_all_field_names():
-                    if (fname_prefix + fname).strip('.') in self.hide_fields:
-                        continue  # skip it
-                    field_type = get_field_type(current_model, fname)
-                    # don't add the field if it's a related field and out of drilldowns range
-                    if field_type in [ManyToManyField]:
-                        temp = (current_related + '__' + fname).strip('__')
-                        if temp not in self.drilldowns:
-                            continue  # don't add this one
-                    add_to_fields_map(current_model, current_map, dot_string=fname, current_related=current_related)
-            else:
-                # add it to the map
-                if current_map.get(fieldname) is None:
-                    current_map[fieldname] = {}
-                    # drill down one level in the map
-                current_map = current_map[fieldname]
+            parts = dot_string.split('.')
+            last = len(parts) - 1
+            for i, fieldname in enumerate(parts):
+                fieldname = fieldname.strip()
+                there_are_subfields = i < last
+                if not (fieldname == 'ALL' or is_field_in(current_model, fieldname)):  # ALL is allowed in fields_map
+                    self.error = ('%s: "%s" is not a valid field' % (ERROR_STRING, '.'.join(parts[i:])))
+                    return None
+
+                if fieldname == 'ALL':
+                    # add in all the fields for the model
+                    fname_prefix = current_related.replace('__', '.') + '.'
+                    for fname in current_model._meta.get_all_field_names():
+                        if (fname_prefix + fname).strip('.') in self.hide_fields:
+                            continue  # skip it
+                        field_type = get_field_type(current_model, fname)
+                        # don't add the field if it's a related field and out of drilldowns range
+                        if field_type in [ManyToManyField]:
+                            temp = (current_related + '__' + fname).strip('__')
+                            if not self._in_drilldowns(temp):
+                                continue  # don't add this one
+                        add_to_fields_map(current_model, current_map, dot_string=fname, current_related=current_related)
+                    return None
+
+                # add it to the map, and drill down one level in the map
+                current_map = current_map.setdefault(fieldname, {})
                 # see if the field is a related one
                 new_model = get_model(current_model, fieldname)
                 field_type = get_field_type(current_model, fieldname)
                 if new_model and (field_type == ManyToManyField or there_are_subfields):
                     # Add field to select_related or prefetch_relateds
                     current_related = (current_related + '__' + fieldname).strip('__')
-                    if current_related in self.drilldowns:
-                        field_type = get_field_type(current_model, fieldname)
-                        if field_type in [ForeignKey, OneToOneField, ManyToOneRel, OneToOneRel]:
-                            self.select_relateds.append(current_related)
-                        else:
-                            self.prefetch_relateds.append(current_related)
+                    if self._in_drilldowns(current_related):
+                        add_related(current_related, field_type)
                     else:
                         self.error = ('%s: %s is not valid' % (ERROR_STRING, current_related.replace('__', '.')))
                         return None
 
-                    # Add sub-field to fields_map
-                    if there_are_subfields:
-                        add_to_fields_map(new_model, current_map, pair[1], current_related)  # recurse
-                    else:
-                        add_to_fields_map(new_model, current_map, 'id')  # defaults to return the id only
+                    if not there_are_subfields:
+                        current_map.setdefault('id', {})  # defaults to return the id only
+                    current_model = new_model  # keep drilling with the sub-fields
                 elif there_are_subfields:  # requested a sub-field for a field that's not a model, e.g. amount.profile
-                    self.error = ('%s: %s not valid field' % (ERROR_STRING, dot_string))
+                    self.error = ('%s: %s not valid field' % (ERROR_STRING, '.'.join(parts[i:])))
                     return None
 
         for fieldname in fields:
             add_to_fields_map(self.model, fields_map, fieldname)
 
         if ERROR_STRING in self.error:
-            fields_map = {}
+            return {}
+
+        # dedupe the prefetches (a lookup can only be prefetched once with a queryset), and drop many-to-manys
+        # where only the ids are wanted; set_m2m_ids() gets those straight from the join table
+        prefetch_relateds = []
+        for p in self.prefetch_relateds:
+            if p not in prefetch_relateds and not self._is_ids_only_m2m(fields_map, p):
+                prefetch_relateds.append(p)
+        # relateds below a prefetched one are selected in the prefetch's own query
+        self.prefetch_relateds = [self._get_prefetch(p, prefetch_selects[p]) if prefetch_selects[p] else p
+                                  for p in prefetch_relateds]
         return fields_map
 
+    def _get_prefetch(self, related_string, select_relateds):
+        """Return a Prefetch for related_string whose query also does select_related(*select_relateds)"""
+        current_model = self.model
+        for fieldname in related_string.split('__'):
+            current_model = get_model(current_model, fieldname)
+        return Prefetch(related_string, queryset=current_model._default_manager.select_related(*select_relateds))
+
+    def _is_ids_only_m2m(self, fields_map, related_string):
+        """Return true if related_string is a many-to-many with just the ids requested"""
+        current_model = self.model
+        for fieldname in related_string.split('__'):
+            field_type = get_field_type(current_model, fieldname)
+            current_model = get_model(current_model, fieldname)
+            fields_map = fields_map.get(fieldname, {})
+        return field_type == ManyToManyField and fields_map == {'id': {}}
+
     def _set_relateds(self, fields_map):
         """Go through the fields_map and see what related objs should be added to the querystring"""
         def add_to_relateds(current_model, current_map, fieldname, current_string=''):
@@ -276,7 +536,7 @@ class DrillDownAPIView(APIView):
                 field_type = get_field_type(current_model, fieldname)
                 current_string = (current_string + '__' + fieldname).strip('__')
                 if field_type in [ForeignKey, OneToOneField, ManyToOneRel, OneToOneRel, ManyToManyField]:
-                    if not current_string in self.drilldowns:
+                    if not self._in_drilldowns(current_string):
                         self.error = ('Error: %s not valid' % current_string.replace('__', '.'))
                         return None
                     if field_type in [ForeignKey, OneToOneField, ManyToOneRel, OneToOneRel]:
@@ -292,6 +552,53 @@ class DrillDownAPIView(APIView):
             add_to_relateds(self.model, fields_map, fieldname)
         return True
 
+    def _set_only_fields(self, fields_map):
+        """
+        Go through the fields_map and return the list of columns to pass to .only(); also narrows the
+        prefetch_relateds to Prefetch objects that only pull the columns needed for the related model
+        """
+        only_fields = []
+        only_prefetches = {}
+
+        def add_to_only(current_model, current_map, current_string=''):
+            for fieldname in current_map:
+                field_type = get_field_type(current_model, fieldname)
+                path = (current_string + '__' + fieldname).strip('__')
+                if field_type == ManyToManyField:
+                    # prefetched, so narrow the prefetch query instead, if it's just flat fields (and not ids only,
+                    # which are already narrowed)
+                    sub_map = current_map[fieldname]
+                    new_model = get_model(current_model, fieldname)
+                    if sub_map != {'id': {}} and all(get_model(new_model, f) is None and
+                                                     get_field_type(new_model, f) != ManyToManyRel for f in sub_map):
+                        only_prefetches[path] = Prefetch(path, queryset=new_model._default_manager.only(*sub_map))
+                elif field_type in [ManyToOneRel, OneToOneRel, ManyToManyRel]:
+                    continue  # reverse relations have no column here
+                else:
+                    only_fields.append(path)  # for a ForeignKey this is the FK column, which select_related needs
+                    if current_map[fieldname] and path in self.select_relateds:
+                        add_to_only(get_model(current_model, fieldname), current_map[fieldname], path)  # recursion
+
+        add_to_only(self.model, fields_map)
+
+        # swap in the narrowed prefetches
+        self.prefetch_relateds = [p if isinstance(p, Prefetch) else only_prefetches.get(p, p)
+                                  for p in self.prefetch_relateds]
+        return only_fields
+
+    def _get_filter_string(self, dot_string):
+        """
+        Takes 'invoice.client.last_name' and puts out a string like 'invoice__client__last_name' if all the fields
+        are valid and accessible to the user
+        """
+        filter_string = self._filter_path_map.get(dot_string)
+        if filter_string is None:
+            if self.picky:
+                self.error = ('"%s" is not a valid filter' % dot_string)
+            else:
+                self.warning += '"%s" is not a valid parameter.  ' % dot_string
+        return filter_string
+
     def _set_filter_kwargs(self, filters):
         """Create the kwargs to filter the querystring with"""
         filter_kwargs = {}
@@ -303,49 +610,7 @@ class DrillDownAPIView(APIView):
             else:
                 operation = ''
 
-            def do_filter(dot_string, filter_string, current_model):
-                """
-                Recursive function that takes 'invoice.client.last_name'
-                and puts out a string like 'invoice__client__last_name' after validating that all the fields are
-                valid and accessible to the user
-                """
-                parts = dot_string.split('.', 1)
-                fieldname = parts[0]
-                filter_string = (filter_string + '__' + fieldname).strip('__')
-                if len(parts) > 1:
-                    leftover = parts[1]
-                else:
-                    leftover = ''
-
-                if not is_field_in(current_model, fieldname):
-                    if self.picky:
-                        self.error = ('"%s" is not a valid filter' % fieldname)
-                    else:
-                        self.warning += '"%s" is not a valid parameter.  ' % filter_string.replace('__', '.')
-                    return None
-
-                if leftover:
-                    field_type = get_field_type(current_model, fieldname)
-                    if filter_string not in self.drilldowns:
-                        if self.picky:
-                            self.error = 'Error in filters: %s' % filter_string.replace('__', '.')
-                        else:
-                            self.warning += '"%s" is not a valid parameter.  ' % filter_string.replace('__', '.')
-                        return None
-                    if field_type not in [ForeignKey, OneToOneField, ManyToOneRel, OneToOneRel, ManyToManyField]:
-                        if self.picky:
-                            self.error = ('Error: %s has no children' % filter_string)
-                        else:
-                            self.warning += '"%s" is not a valid parameter.  ' % filter_string.replace('__', '.')
-                        return None
-
-                    # go to the related model
-                    current_model = get_model(current_model, fieldname)
-                    return do_filter(leftover, filter_string, current_model)  # recursion
-                else:
-                    return filter_string
-
-            filter_string = do_filter(dot_string, '', self.model)
+            filter_string = self._get_filter_string(dot_string)
 
             if filter_string:
                 # __in operator requires a list to work with so making it a special case for now.
@@ -354,93 +619,403 @@ class DrillDownAPIView(APIView):
                     comma_separated_multiple_values = self.request.QUERY_PARAMS[p]
                     filter_kwargs[filter_string + operation] = comma_separated_multiple_values.split(",")
                 else:
-                    filter_kwargs[filter_string + operation] = self.request.QUERY_PARAMS[p]
-
-        for k in filter_kwargs:
-            if filter_kwargs[k] in ['true', 'True']:
-                filter_kwargs[k] = True
-            elif filter_kwargs[k] in ['false', 'False']:
-                filter_kwargs[k] = False
+                    value = self.request.QUERY_PARAMS[p]
+                    filter_kwargs[filter_string + operation] = _BOOL_MAP.get(value, value)
 
         return filter_kwargs
 
 
-def DrilldownSerializerFactory(the_model):
-    """Creates a generic model serializer with sub-serializers, based on the fields map """
-    class Serializer(serializers.ModelSerializer):
-        class Meta:
-            model = the_model
+class CachedDrilldownMixin(object):
+    """
+    Mix this in ahead of DrillDownAPIView to cache successful GET responses, keyed by the view and the query params:
+
+        class InvoiceList(CachedDrilldownMixin, DrillDownAPIView):
+            cache_timeout = 60
+            cache_freshness_field = 'updated_at'
 
-        def __init__(self, *args, **kwargs):
-            # pull off the fields_map argument; don't pass to superclass
-            if 'fields_map' in kwargs:
-                fields_map = kwargs.pop('fields_map')
-                fields_map = fields_map
+    If cache_freshness_field is set, its max value is part of the key, so edits to the model show up right away.
+    Deletes are not picked up until the cache times out. If get_base_query() depends on the user, override
+    get_cache_key() to include the user.
+    """
+    cache_timeout = None  # seconds to cache responses for; None turns caching off
+    cache_freshness_field = None  # e.g. 'updated_at'
+    CACHED_HEADERS = ['X-Total-Count', 'X-Has-More', 'X-Query_Warning']
+
+    def get_cache_key(self):
+        """Key for the response to this request"""
+        view = type(self)
+        key_parts = [view.__module__, view.__name__, self._settings_key, sorted(self.request.QUERY_PARAMS.lists())]
+        if self.cache_freshness_field:
+            key_parts.append(self.model._default_manager.aggregate(
+                latest=Max(self.cache_freshness_field))['latest'])
+        return 'drilldown:' + hashlib.sha1(repr(key_parts).encode('utf-8')).hexdigest()
+
+    def get(self, request):
+        if not self.cache_timeout:
+            return super(CachedDrilldownMixin, self).get(request)
+
+        key = self.get_cache_key()
+        cached = cache.get(key)
+        if cached is not None:
+            data, headers = cached
+            return Response(data, headers=headers)
+
+        response = super(CachedDrilldownMixin, self).get(request)
+        if response.status_code == 200 and isinstance(response, Response):  # streamed responses aren't cached
+            headers = dict((h, response[h]) for h in self.CACHED_HEADERS if response.has_header(h))
+            cache.set(key, (list(response.data), headers), self.cache_timeout)
+        return response
+
+
+# Serializer classes are cached by (model, fields_map), so DRF's field introspection is reused across requests
+_SERIALIZER_CACHE = {}
+_SERIALIZER_CACHE_SIZE = 500  # the fields come from the client, so don't let the cache grow without bound
+
+
+def DrilldownSerializerFactory(the_model, fields_map=None):
+    """Returns a generic model serializer with sub-serializers, based on the fields map (ids only if no fields_map)"""
+    fields_map = fields_map or {'id': {}}
+    key = (the_model, _freeze(fields_map))
+    serializer_class = _SERIALIZER_CACHE.get(key)
+    if serializer_class is None:
+        if len(_SERIALIZER_CACHE) >= _SERIALIZER_CACHE_SIZE:
+            _SERIALIZER_CACHE.clear()
+        serializer_class = _SERIALIZER_CACHE[key] = _build_serializer(the_model, fields_map)
+    return serializer_class
+
+
+def _build_serializer(the_model, fields_map):
+    """Builds a model serializer limited to the fields in fields_map, recursing for fields with sub-fields"""
+    attrs = {}
+    meta_fields = []
+    for field_name in fields_map:
+        sub_fm = fields_map[field_name]
+        ftype = get_field_type(the_model, field_name)
+        if sub_fm and sub_fm != {'id': {}}:  # only do this for fields with sub-fields requested
+            if ftype in [ForeignKey, OneToOneField, ManyToOneRel, OneToOneRel, ManyToManyField]:
+                m = get_model(the_model, field_name)
+                attrs[field_name] = DrilldownSerializerFactory(m, sub_fm)(
+                    many=ftype in [ManyToManyField, ManyToOneRel])  # recursively create another serializer
+        elif ftype == ManyToManyField:
+            attrs[field_name] = ManyToManyIdsField()  # ids only; read straight from the join table
+        if field_name in attrs or ftype not in [ManyToOneRel, OneToOneRel, ManyToManyRel]:
+            meta_fields.append(field_name)  # reverse relations are only included with sub-fields
+
+    attrs['Meta'] = type('Meta', (object,), {'model': the_model, 'fields': tuple(meta_fields)})
+    return type('%sDrilldownSerializer' % the_model.__name__, (serializers.ModelSerializer,), attrs)
+
+
+class ManyToManyIdsField(getattr(serializers, 'ReadOnlyField', serializers.Field)):  # Field is read-only in DRF 2
+    """Read-only field for a many-to-many, giving a list of ids; uses the list from set_m2m_ids() if there is one"""
+    def field_to_native(self, obj, field_name):  # DRF 2
+        return get_m2m_ids(obj, field_name)
+
+    def get_attribute(self, instance):  # DRF 3
+        return get_m2m_ids(instance, self.field_name)
+
+
+def m2m_ids_attr(fieldname):
+    """Name of the attribute that set_m2m_ids() puts the id list for a many-to-many field in"""
+    return '_%s_ids' % fieldname
+
+
+def get_m2m_ids(obj, fieldname):
+    """Get the list of ids for a many-to-many field of obj"""
+    attr = m2m_ids_attr(fieldname)
+    if hasattr(obj, attr):
+        return getattr(obj, attr)
+    return [o.pk for o in getattr(obj, fieldname).all()]
+
+
+def set_m2m_ids(objs, fields_map, model):
+    """
+    For each many-to-many in fields_map with just the ids requested, read the ids for all the objs from the join
+    table in one query, and put each obj's list in an attribute; saves loading the related objects just for their ids
+    """
+    for field_name in fields_map:
+        sub_fm = fields_map[field_name]
+        ftype = get_field_type(model, field_name)
+        if not objs or ftype not in [ForeignKey, OneToOneField, ManyToManyField]:
+            continue
+        if ftype == ManyToManyField and (not sub_fm or sub_fm == {'id': {}}):
+            ids = _fast_m2m_ids(objs, model, field_name)
+            attr = m2m_ids_attr(field_name)
+            for obj in objs:
+                setattr(obj, attr, ids.get(obj.pk, []))
+        elif sub_fm and sub_fm != {'id': {}}:
+            # drill down through the related objects already loaded by select_related / prefetch_related
+            if ftype == ManyToManyField:
+                related = [r for obj in objs for r in getattr(obj, field_name).all()]
             else:
-                fields_map = {}
-
-            super(Serializer, self).__init__(*args, **kwargs)
-
-            if fields_map:
-                # recurse through the fields dict, setting the fields list for each level and building sub-serializers
-                def prune_fields(fields_map, model):
-                    # Set the list of fields for this serializer
-                    requested = list(fields_map)  # flatten to get fields requested for this specific serializer model
-                    available = list(self.fields)  # by default this is all fields for the model
-                    for field_name in set(available) - set(requested):
-                        self.fields.pop(field_name)  # delete the ones we don't want from the serializer
-                        if field_name in fields_map:  # and from fields_map
-                            del fields_map[field_name]
-                        # Attach sub-serializers for relationship fields
-                    for field_name in fields_map:
-                        sub_fm = fields_map[field_name]
-                        if sub_fm and sub_fm != {'id': {}}:  # only do this for fields with sub-fields requested
-                            ftype = get_field_type(model, field_name)
-                            if ftype in [ForeignKey, OneToOneField, ManyToOneRel, OneToOneRel, ManyToManyField]:
-                                m = get_model(model, field_name)
-                                self.fields[field_name] = DrilldownSerializerFactory(m)(
-                                    fields_map=fields_map[field_name])  # recursively create another serializer
-
-                prune_fields(fields_map=fields_map, model=self.Meta.model)
+                related = [r for r in (getattr(obj, field_name) for obj in objs) if r is not None]
+            set_m2m_ids(related, sub_fm, get_model(model, field_name))  # recursion
+
+
+def _fast_m2m_ids(parents, model, fieldname):
+    """
+    Returns {parent id: [related ids]} for a many-to-many field, from one query on the join table; the ids are in
+    the related model's default ordering, as they would be from the related manager
+    """
+    field = _field_obj(model, fieldname)
+    source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    ordering = [('-' if o.startswith('-') else '') + target + '__' + o.lstrip('-')
+                for o in field.rel.to._meta.ordering if o != '?']
+    rows = field.rel.through._default_manager.filter(**{source + '__in': set(p.pk for p in parents)})
+    related_manager = field.rel.to._default_manager
+    if type(related_manager) is not Manager:
+        # the related manager may hide rows (e.g. soft-deleted ones), so only take ids its queryset gives
+        rows = rows.filter(**{target + '__in': related_manager.all()})
+    rows = rows.order_by(*ordering).values_list(source, target)
+    ids = defaultdict(list)
+    for parent_id, related_id in rows:
+        ids[parent_id].append(related_id)
+    return ids
+
+
+# model fields whose value is already what the serializer gives for them (when they don't have choices)
+_RAW_FIELD_TYPES = (AutoField, BooleanField, NullBooleanField, CharField, TextField, IntegerField, FloatField)
+_LEAF_CONVERTER_CACHE = {}
+
+
+def _leaf_converter(model, field_name):
+    """
+    Returns a function that turns a value of model.field_name into what the serializer gives for it (e.g. a
+    formatted datetime), or None if the value needs no converting; the DRF field is built once per model field
+    """
+    key = (model, field_name)
+    if key not in _LEAF_CONVERTER_CACHE:
+        field = _field_obj(model, field_name)
+        converter = None
+        if not isinstance(field, _RAW_FIELD_TYPES) or field.choices:
+            drf_field = DrilldownSerializerFactory(model, {field_name: {}})().fields[field_name]
+            convert = getattr(drf_field, 'to_representation', None) or drf_field.to_native  # DRF 3 or DRF 2
+
+            def converter(value):
+                return None if value is None else convert(value)
+        _LEAF_CONVERTER_CACHE[key] = converter
+    return _LEAF_CONVERTER_CACHE[key]
+
+
+def _can_fast_serialize(model, fields_map):
+    """Return true if _fast_serialize gives the same results as the serializer for this fields_map"""
+    for field_name in fields_map:
+        ftype = get_field_type(model, field_name)
+        sub_fm = fields_map[field_name]
+        if ftype in [ManyToOneRel, OneToOneRel, ManyToManyRel] and (not sub_fm or sub_fm == {'id': {}}):
+            continue  # the serializer leaves these out, and so does _fast_serialize
+        if ftype in [ManyToOneRel, OneToOneRel] or isinstance(_field_obj(model, field_name), FileField):
+            return False  # reverse relations and file urls are left to the serializer
+        if ftype in [ForeignKey, OneToOneField, ManyToManyField] and sub_fm and sub_fm != {'id': {}}:
+            if not _can_fast_serialize(get_model(model, field_name), sub_fm):  # recursion
+                return False
+    return True
+
+
+def _fast_serialize(obj, fields_map, model):
+    """Turn obj into a dict of the fields in fields_map, reading the attributes already loaded by the query"""
+    result = {}
+    for field_name in fields_map:
+        sub_fm = fields_map[field_name]
+        ftype = get_field_type(model, field_name)
+        if ftype in [ManyToOneRel, OneToOneRel, ManyToManyRel]:
+            continue  # reverse relations are only included with sub-fields, which the serializer handles
+        if ftype == ManyToManyField:
+            if sub_fm and sub_fm != {'id': {}}:
+                m = get_model(model, field_name)
+                result[field_name] = [_fast_serialize(o, sub_fm, m) for o in getattr(obj, field_name).all()]
+            else:
+                result[field_name] = get_m2m_ids(obj, field_name)
+        elif ftype in [ForeignKey, OneToOneField]:
+            if sub_fm and sub_fm != {'id': {}}:
+                related = getattr(obj, field_name)
+                result[field_name] = (None if related is None else
+                                      _fast_serialize(related, sub_fm, get_model(model, field_name)))  # recursion
+            else:
+                result[field_name] = getattr(obj, _field_obj(model, field_name).attname)  # the id, without a query
+        else:
+            value = getattr(obj, field_name)
+            converter = _leaf_converter(model, field_name)
+            result[field_name] = value if converter is None else converter(value)
+    return result
+
+
+def _get_values_plan(model, fields_map):
+    """
+    Returns (lookups, plan) for getting the fields_map with .values(lookups) and turning the rows into nested dicts
+    with _reshape_values(row, plan); or None if the fields_map has fields that .values() can't give us
+    """
+    lookups = ['pk']  # always there, so that .distinct() in the base query can't merge rows of different objects
+
+    def make_plan(current_model, current_map, current_string=''):
+        plan = []  # list of (name in the result, key in the values row, sub-plan or None, converter or None)
+        for field_name in current_map:
+            ftype = get_field_type(current_model, field_name)
+            if ftype in [ManyToManyField, ManyToOneRel, OneToOneRel, ManyToManyRel] or isinstance(
+                    _field_obj(current_model, field_name), FileField):
+                return None  # many-valued relations, and file urls, need the model instances
+            lookup = (current_string + '__' + field_name).strip('__')
+            if lookup not in lookups:
+                lookups.append(lookup)  # for a ForeignKey this is the id, which also tells us if it's null
+            sub_fm = current_map[field_name]
+            sub_plan = converter = None
+            if ftype in [ForeignKey, OneToOneField]:
+                if sub_fm and sub_fm != {'id': {}}:
+                    sub_plan = make_plan(get_model(current_model, field_name), sub_fm, lookup)  # recursion
+                    if sub_plan is None:
+                        return None
             else:
-                # if no fields specified, return ids only
-                for field_name in set(self.fields):
-                    if field_name != 'id':
-                        self.fields.pop(field_name)
-    return Serializer
+                converter = _leaf_converter(current_model, field_name)  # the same value the serializer gives
+            plan.append((field_name, lookup, sub_plan, converter))
+        return plan
+
+    plan = make_plan(model, fields_map)
+    return None if plan is None else (lookups, plan)
+
+
+def _reshape_values(row, plan):
+    """Turn a flat .values() row into nested dicts, following the plan from _get_values_plan"""
+    result = {}
+    for name, key, sub_plan, converter in plan:
+        if converter is not None:
+            result[name] = converter(row[key])
+        elif sub_plan is None:
+            result[name] = row[key]
+        else:
+            result[name] = None if row[key] is None else _reshape_values(row, sub_plan)  # recursion
+    return result
+
+
+def _freeze(fields_map):
+    """Turn a fields_map into a hashable, order-independent tuple"""
+    return tuple(sorted((name, _freeze(sub_fm)) for name, sub_fm in fields_map.items()))
 
 
 # Some utilities
+class QueryCounter(object):
+    """
+    Context manager that counts the queries run on a connection, from its debug query log (so needs DEBUG); reads
+    the length of connection.queries_log where there is one (Django 1.8+), since connection.queries copies it
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.count = 0
+        self._start = 0
+
+    def _log_length(self):
+        queries_log = getattr(self.connection, 'queries_log', None)
+        return len(self.connection.queries if queries_log is None else queries_log)
+
+    def __enter__(self):
+        self._start = self._log_length()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.count = self._log_length() - self._start
+
+
+# Model meta lookups are slow and never change for a model, so they are cached per (model, fieldname)
+_FIELD_CACHE = {}
+_FIELD_NAMES_CACHE = {}
+_RELATED_MODEL_CACHE = {}
+
+
+def _field_obj(model, fieldname):
+    """Get the field (or related object) named fieldname in model"""
+    key = (model, fieldname)
+    field = _FIELD_CACHE.get(key)
+    if field is None:
+        field = _FIELD_CACHE[key] = model._meta.get_field_by_name(fieldname)[0]
+    return field
+
+
+def _all_field_names(model):
+    """Get the set of field and relatedobject names in model"""
+    fieldnames = _FIELD_NAMES_CACHE.get(model)
+    if fieldnames is None:
+        fieldnames = _FIELD_NAMES_CACHE[model] = frozenset(model._meta.get_all_field_names())
+    return fieldnames
+
+
 def get_model(parent_model, fieldname):
     """Get the model of a foreignkey, manytomany, etc. field"""
-    field_class = parent_model._meta.get_field(fieldname)
-    field_type = type(field_class)
-    if field_type in [ForeignKey, ManyToManyField, OneToOneField]:
-        model = parent_model._meta.get_field(fieldname).rel.to
-    elif field_type == ManyToOneRel:
-        model = parent_model._meta.get_field_by_name(fieldname)[0].model
-    elif field_type == OneToOneRel:
-        model = field_class.related_model
-    else:
-        model = None
-    return model
+    key = (parent_model, fieldname)
+    if key not in _RELATED_MODEL_CACHE:
+        field_class = _field_obj(parent_model, fieldname)
+        field_type = type(field_class)
+        if field_type in [ForeignKey, ManyToManyField, OneToOneField]:
+            model = field_class.rel.to
+        elif field_type == ManyToOneRel:
+            model = field_class.model
+        elif field_type == OneToOneRel:
+            model = field_class.related_model
+        else:
+            model = None
+        _RELATED_MODEL_CACHE[key] = model
+    return _RELATED_MODEL_CACHE[key]
 
 
 def get_field_type(model, fieldname):
     """Get the type of a field in a model"""
-    return type(model._meta.get_field_by_name(fieldname)[0])
+    return type(_field_obj(model, fieldname))
 
 
 def is_field_in(model, fieldname):
     """Return true if fieldname is a field or relatedobject in model"""
-    fieldnames = model._meta.get_all_field_names()
-    return fieldname in fieldnames
+    return fieldname in _all_field_names(model)
+
+
+def _iter_in_chunks(qs, fields_map, model):
+    """
+    Iterate over the objects in qs without loading them all at once; the prefetches and set_m2m_ids() are done
+    for each chunk of objects as it's read
+    """
+    lookups = list(qs._prefetch_related_lookups)
+
+    def load(chunk):
+        if lookups:
+            prefetch_related_objects(chunk, lookups)
+        set_m2m_ids(chunk, fields_map, model)
+        return chunk
+
+    chunk = []
+    for obj in qs.prefetch_related(None).iterator():  # iterator() would skip the prefetches anyway
+        chunk.append(obj)
+        if len(chunk) == _STREAM_CHUNK_SIZE:
+            for loaded in load(chunk):
+                yield loaded
+            chunk = []
+    for loaded in load(chunk):
+        yield loaded
+
+
+def _json_stream(rows):
+    """Yield a json list of the rows, a row at a time"""
+    yield b'['
+    separator = b''
+    for row in rows:
+        yield separator + json_dumps(row)
+        separator = b','
+    yield b']'
+
+
+def estimate_count(queryset):
+    """Return the query planner's row estimate for a queryset, or None if the database can't give one"""
+    db_connection = connections[queryset.db]
+    if db_connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()  # built for the queryset's own database
+    with db_connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if not isinstance(plan, list):
+        plan = json.loads(plan)  # older drivers return the plan as a string
+    return int(plan[0]['Plan']['Plan Rows'])
 
 
 def int_or_none(value):
-    """Convenience method to return None if int fails"""
-    try:
-        result = int(value)
-    except (ValueError, TypeError):
-        result = None
-    return result
+    """Convenience method to return None if value isn't an int or a string of one"""
+    if isinstance(value, int):
+        return value
+    if isinstance(value, (str, type(u''))) and _INT_RE.match(value):
+        return int(value)
+    return None
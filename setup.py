@@ -18,4 +18,5 @@ setup(
     author='Peter Hollingsworth',
     author_email='peter@hollingsworth.net',
     install_requires=['djangorestframework<3.9.4'],
+    extras_require={'orjson': ['orjson']},
 )